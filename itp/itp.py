@@ -19,12 +19,27 @@
 # -----------------------------------------------------------------------------
 from __future__ import unicode_literals
 
+import os
 import re
+import string
 import sys
+import threading
 try:
     from urllib.parse import quote  # Python3
 except ImportError:
     from urllib import quote
+try:
+    from functools import lru_cache  # Python3
+except ImportError:
+    def lru_cache(maxsize):
+        return lambda func: func
+
+# RE2 guarantees linear time matching, but its Python bindings are slower
+# than re on typical captions, so it's only used when asked for
+if os.environ.get('ITP_REGEX_ENGINE') == 're2':
+    import re2
+else:
+    re2 = None
 
 __version__ = "2.0.1"
 
@@ -33,6 +48,73 @@ UTF_CHARS = r'a-z0-9_\u00c0-\u00d6\u00d8-\u00f6\u00f8-\u00ff'
 SPACES = r'[\u0020\u00A0\u1680\u180E\u2002-\u202F\u205F\u2060\u3000]'
 
 
+# RE2's `\s` only matches ASCII whitespace, this is everything Python's does
+RE2_SPACES = (r'\s\x{b}\x{1c}-\x{1f}\x{85}\x{a0}\x{1680}\x{2000}-\x{200a}'
+              r'\x{2028}\x{2029}\x{202f}\x{205f}\x{3000}')
+
+# re.IGNORECASE also matches the dotted and dotless i with `[a-z]`, RE2's case
+# folding doesn't
+RE2_DOTTED_I = r'\x{130}\x{131}'
+
+
+def _re2_pattern(pattern, flags):
+    '''Translate a pattern to RE2 syntax.'''
+    pattern = re.sub(r'\\u([0-9a-fA-F]{4})', r'\\x{\1}', pattern)
+    ignorecase = [bool(flags & re.IGNORECASE)]
+
+    def translate(match):
+        token = match.group(0)
+        if token == r'\s':
+            return '[' + RE2_SPACES + ']'
+
+        elif token.startswith('['):
+            token = re.sub(r'\\.', lambda escape: RE2_SPACES
+                           if escape.group(0) == r'\s' else escape.group(0),
+                           token)
+            if ignorecase[-1] and ('a-z' in token or 'A-Z' in token):
+                token = token[:-1] + RE2_DOTTED_I + ']'
+
+        # Keep track of groups matched case sensitively
+        elif token == '(?-i:':
+            ignorecase.append(False)
+
+        elif token == '(':
+            ignorecase.append(ignorecase[-1])
+
+        elif token == ')':
+            ignorecase.pop()
+
+        return token
+
+    pattern = re.sub(r'\[(?:\\.|[^\]\\])*\]|\\.|\(\?-i:|[()]', translate,
+                     pattern)
+    if flags & re.IGNORECASE:
+        pattern = '(?i)' + pattern
+
+    return pattern
+
+
+def _compile(pattern, flags=0, re2_pattern=None):
+    '''Compile a pattern with RE2 if it is installed, otherwise with re.
+
+    RE2 matches in linear time, so it can't be made to backtrack
+    catastrophically by crafted captions. Patterns RE2 does not support are
+    compiled with re instead. `re2_pattern` is an RE2 specific alternative to
+    `pattern`, for patterns that need different syntax in both engines.
+    RE2 always folds case with Unicode rules, so case insensitive patterns
+    with re.ASCII are compiled with re as well.
+    '''
+    ascii_only = flags & getattr(re, 'ASCII', 0) and flags & re.IGNORECASE
+    if re2 is not None and not ascii_only:
+        re2_pattern = _re2_pattern(re2_pattern or pattern, flags)
+        try:
+            return re2.compile(re2_pattern)
+        except re2.error:
+            pass
+
+    return re.compile(pattern, flags)
+
+
 # Users
 if sys.version_info >= (3, 0):
     username_flags = re.ASCII | re.IGNORECASE
@@ -40,21 +122,25 @@ else:
     username_flags = re.IGNORECASE
 
 # The username regex will match invalid usernames that start on dots, end on
-# dots and include repeated dots. Those usernames are parsed without regex
-# in the actual parser in `Parser._parse_username()`
-USERNAME_CHARS = r'([a-z0-9_.]{1,30})(/[a-z][a-z0-9\x80-\xFF-]{0,79})?'
-
-USERNAME_REGEX = re.compile(r'\B' + AT_SIGNS + USERNAME_CHARS, username_flags)
+# dots and include repeated dots. Those usernames are split into their valid
+# part and the rest with VALID_USERNAME_REGEX in `Parser._parse_username()`
+USERNAME_CHARS = (r'(?P<username>[A-Za-z0-9_.]{1,30})'
+                  r'(?P<list>/[A-Za-z][A-Za-z0-9\x80-\xFF-]{0,79})?')
+
+USERNAME_REGEX = _compile(r'\B' + AT_SIGNS + USERNAME_CHARS, username_flags)
+VALID_USERNAME_REGEX = _compile(r'([a-z0-9_]+(?:\.[a-z0-9_]+)*)(.*)',
+                                username_flags)
 REPLY_REGEX = re.compile(r'^(?:' + SPACES + r')*' + AT_SIGNS
                          + r'([a-z0-9_]{1,20}).*', re.IGNORECASE)
 
 # Hashtags
-HASHTAG_EXP = r'(#|\uff03)([0-9A-Z_]+[%s]*)' % UTF_CHARS
-HASHTAG_REGEX = re.compile(HASHTAG_EXP, re.IGNORECASE)
+SAFE_TAG_CHARS = frozenset(string.ascii_letters + string.digits + '_')
+HASHTAG_EXP = r'(?P<hash>#|\uff03)(?P<tag>[0-9A-Z_]+[%s]*)' % UTF_CHARS
+HASHTAG_REGEX = _compile(HASHTAG_EXP, re.IGNORECASE)
 
 # URLs
 PRE_CHARS = r'(?:[^/"\':!=]|^|\:)'
-DOMAIN_CHARS = r'([\.-]|[^\s_\!\.\/])+\.[a-z]{2,}(?::[0-9]+)?'
+DOMAIN_CHARS = r'[^\s_\!\/]+\.[a-z]{2,}(?::[0-9]+)?'
 PATH_CHARS = r'(?:[\.,]?[%s!\*\'\(\);:=\+\$/%s#\[\]\-_,~@])' % (UTF_CHARS, '%')
 QUERY_CHARS = r'[a-z0-9!\*\'\(\);:&=\+\$/%#\[\]\-_\.,~]'
 
@@ -64,14 +150,67 @@ QUERY_CHARS = r'[a-z0-9!\*\'\(\);:&=\+\$/%#\[\]\-_\.,~]'
 PATH_ENDING_CHARS = r'[%s\)=#/]' % UTF_CHARS
 QUERY_ENDING_CHARS = '[a-z0-9_&=#]'
 
-URL_REGEX = re.compile('((%s)((https?://|www\\.)(%s)(\/(%s*%s)?)?(\?%s*%s)?))'
-                       % (PRE_CHARS, DOMAIN_CHARS, PATH_CHARS,
-                          PATH_ENDING_CHARS, QUERY_CHARS, QUERY_ENDING_CHARS),
-                       re.IGNORECASE)
+URL_EXP = (r'((?P<pre>%s)(((?P<scheme>https?://)|www\.)(?P<domain>%s)(\/(%s*%s)?)?(\?%s*%s)?))'
+           % (PRE_CHARS, DOMAIN_CHARS, PATH_CHARS,
+              PATH_ENDING_CHARS, QUERY_CHARS, QUERY_ENDING_CHARS))
+URL_REGEX = _compile(URL_EXP, re.IGNORECASE)
+
+# All entities at once, so HTML can be generated in a single pass over the
+# text. Without re.ASCII Python's `\B` also treats non ASCII letters as word
+# characters, so the username boundary is spelled out as a lookbehind. RE2
+# doesn't support lookbehinds, but its `\B` is always ASCII only.
+#
+# re.IGNORECASE without re.ASCII also matches `\u0130`, `\u0131`, `\u017f`
+# and `\u212a` with `[a-z]`, so usernames are matched case sensitively with
+# explicit classes. Scoped inline flags need Python 3.6, Python 2 only folds
+# ASCII anyway.
+#
+# There are no bytes versions of the patterns for ASCII only captions: Python
+# 3 already stores those with one byte per character, re matches them as fast
+# as bytes, and encoding would only add a copy.
+USER_BOUNDARY = r'(?<![0-9A-Za-z_])'
+if sys.version_info >= (3, 6):
+    USER_EXP = r'(?P<user>(?-i:%s' + AT_SIGNS + USERNAME_CHARS + '))'
+else:
+    USER_EXP = r'(?P<user>%s' + AT_SIGNS + USERNAME_CHARS + ')'
+HASHTAG_ENTITY_EXP = '(?P<hashtag>' + HASHTAG_EXP + ')'
+
+ENTITY_REGEX = _compile(
+    '(?P<url>' + URL_EXP + ')|' + USER_EXP % USER_BOUNDARY
+    + '|' + HASHTAG_ENTITY_EXP, re.IGNORECASE,
+    re2_pattern='(?P<url>' + URL_EXP + ')|' + USER_EXP % r'\B'
+    + '|' + HASHTAG_ENTITY_EXP)
+
+# Users and hashtags only, for the text in and around URLs
+USER_TAG_REGEX = _compile(
+    USER_EXP % USER_BOUNDARY + '|' + HASHTAG_ENTITY_EXP, re.IGNORECASE,
+    re2_pattern=USER_EXP % r'\B' + '|' + HASHTAG_ENTITY_EXP)
+
+# What URLs start with, and the text a URL can span at most, for
+# `Parser._find_url()`
+URL_STARTS = ('http://', 'https://', 'www.')
+NON_SPACES_REGEX = re.compile(r'\S*')
 
 # Registered IANA one letter domains
-IANA_ONE_LETTER_DOMAINS = (
-    'x.com', 'x.org', 'z.com', 'q.net', 'q.com', 'i.net')
+IANA_ONE_LETTER_DOMAINS = frozenset((
+    'x.com', 'x.org', 'z.com', 'q.net', 'q.com', 'i.net'))
+IANA_ONE_LETTER_TLDS = frozenset(('.com', '.org', '.net'))
+
+
+# Quick checks, used to skip a regex pass over text that can't possibly match
+def _may_have_urls(text):
+    '''Check for the `https?://` or `www.` every URL starts with.'''
+    return '://' in text or ('.' in text and 'www.' in text.lower())
+
+
+def _may_have_users(text):
+    '''Check for an at sign.'''
+    return '@' in text or '\uff20' in text
+
+
+def _may_have_tags(text):
+    '''Check for a hash sign.'''
+    return '#' in text or '\uff03' in text
 
 
 class ParseResult(object):
@@ -100,15 +239,47 @@ class ParseResult(object):
         To change the formatting sublcass twp.Parser and override the format_*
         methods.
 
+    - url_spans, user_spans, tag_spans
+        Lists containing the (start, end) span of each url, user and tag if the
+        parser includes spans, None otherwise. With spans, urls, users and
+        tags contain (entity, span) tuples, which are only built when used.
+        Until then they don't show up in vars() of the result.
+
+    - url_strings, user_strings, tag_strings
+        Lists containing just the urls, users and tags, with or without spans.
+        Without spans these are the same lists as urls, users and tags, with
+        spans they are separate lists and changing one doesn't change the
+        other.
+
     '''
 
-    def __init__(self, urls, users, reply, tags, html):
-        self.urls = urls if urls else []
-        self.users = users if users else []
+    def __init__(self, urls, users, reply, tags, html,
+                 url_spans=None, user_spans=None, tag_spans=None):
+        self.url_strings = urls if urls else []
+        self.user_strings = users if users else []
         self.reply = reply if reply else None
-        self.tags = tags if tags else []
+        self.tag_strings = tags if tags else []
         self.html = html
 
+        self.url_spans = url_spans
+        self.user_spans = user_spans
+        self.tag_spans = tag_spans
+        if url_spans is None:
+            self.urls = self.url_strings
+            self.users = self.user_strings
+            self.tags = self.tag_strings
+
+    def __getattr__(self, name):
+        '''Pair up entities with their spans on first use.'''
+        if name not in ('urls', 'users', 'tags'):
+            raise AttributeError(name)
+
+        entity = name[:-1]
+        value = list(zip(getattr(self, entity + '_strings'),
+                         getattr(self, entity + '_spans')))
+        setattr(self, name, value)
+        return value
+
 
 class Parser(object):
 
@@ -118,157 +289,322 @@ class Parser(object):
         self._max_url_length = max_url_length
         self._include_spans = include_spans
 
+        # Pick the collectors once, instead of checking on every match
+        if include_spans:
+            self._collect_user = self._collect_user_with_span
+            self._collect_tag = self._collect_tag_with_span
+
     def parse(self, text, html=True):
         '''Parse the text and return a ParseResult instance.'''
+
+        # Skip all the regexes for text without any entities, which is true
+        # for most short comments
+        if not (_may_have_users(text) or _may_have_tags(text)
+                or _may_have_urls(text)):
+            if self._include_spans:
+                return ParseResult(None, None, None, None,
+                                   text if html else None, [], [], [])
+
+            return ParseResult(None, None, None, None, text if html else None)
+
         self._urls = []
         self._users = []
         self._tags = []
+        if self._include_spans:
+            self._url_spans = []
+            self._user_spans = []
+            self._tag_spans = []
+        else:
+            self._url_spans = self._user_spans = self._tag_spans = None
 
         reply = REPLY_REGEX.match(text)
         reply = reply.groups(0)[0] if reply is not None else None
 
         parsed_html = self._html(text) if html else self._text(text)
         return ParseResult(self._urls, self._users, reply,
-                           self._tags, parsed_html)
+                           self._tags, parsed_html, self._url_spans,
+                           self._user_spans, self._tag_spans)
+
+    def parse_batch(self, texts, html=True):
+        '''Parse many texts and return a list of ParseResult instances.'''
+        parse = self.parse
+        return [parse(text, html) for text in texts]
 
     def _text(self, text):
         '''Parse a caption/comment without generating HTML.'''
-        URL_REGEX.sub(self._parse_urls, text)
-        USERNAME_REGEX.sub(self._parse_users, text)
-        HASHTAG_REGEX.sub(self._parse_tags, text)
+        self._scan(text, None)
         return None
 
     def _html(self, text):
         '''Parse a caption/comment and generate HTML.'''
-        html = URL_REGEX.sub(self._parse_urls, text)
-        html = USERNAME_REGEX.sub(self._parse_users, html)
-        return HASHTAG_REGEX.sub(self._parse_tags, html)
+        parts = []
+        self._scan(text, parts)
+        return ''.join(parts)
 
     # Internal parser stuff ---------------------------------------------------
-    def _parse_urls(self, match):
+    def _scan(self, text, parts):
+        '''Parse URLs, usernames and hashtags, appending HTML to parts.
+
+        Both modes go through here, so they always find the same entities. No
+        HTML is generated if parts is None.
+        '''
+        pos = 0
+        matches = ENTITY_REGEX.finditer(text)
+        match = next(matches, None)
+        while match is not None:
+            start = match.start(0)
+
+            # Skip the matches in a URL a username or hashtag ran into, and
+            # search again in the rare case of one running past its end
+            if start < pos:
+                if match.end(0) > pos:
+                    matches = ENTITY_REGEX.finditer(text, pos)
+
+                match = next(matches, None)
+                continue
+
+            if parts is not None:
+                parts.append(text[pos:start])
+
+            pos = match.end(0)
+            if match.lastgroup == 'url':
+                self._parse_urls(match, parts)
+
+            else:
+                url, offset = self._find_url(match)
+                if url is None:
+                    self._parse_entities(match, parts)
+
+                # A username or hashtag running into a URL ends where the URL
+                # starts, `#tagwww.example.com` is `#tag` and a URL
+                else:
+                    pre = url.group('pre')
+                    self._parse_region(text, start,
+                                       offset + url.start(0) + len(pre), parts)
+                    self._link_url(url, pre, parts, offset)
+                    pos = offset + url.end(0)
+
+            match = next(matches, None)
+
+        if parts is not None:
+            parts.append(text[pos:])
+
+    def _parse_region(self, text, start, end, parts):
+        '''Parse the usernames and hashtags between start and end of text.
+
+        Only the region and the character before it, which is looked at for
+        word boundaries and lookbehinds, are matched. RE2's bindings encode
+        all of the text they are given on every call.
+        '''
+        offset = start - 1 if start else 0
+        text = text[offset:end]
+        start -= offset
+        for match in USER_TAG_REGEX.finditer(text, start):
+            if parts is not None:
+                parts.append(text[start:match.start(0)])
+
+            self._parse_entities(match, parts, offset)
+            start = match.end(0)
+
+        if parts is not None:
+            parts.append(text[start:])
+
+    def _parse_entities(self, match, parts, offset=0):
+        '''Parse usernames and hashtags.'''
+
+        if match.lastgroup == 'user':
+            self._parse_users(match, parts, offset)
+        else:
+            self._parse_tags(match, parts, offset)
+
+    def _parse_urls(self, match, parts):
         '''Parse URLs.'''
 
-        mat = match.group(0)
+        # Link the users and hashtags in invalid URLs like in any other text
+        if not self._is_valid_url(match):
+            self._parse_region(match.string, match.start(0), match.end(0),
+                               parts)
+            return
+
+        pre = match.group('pre')
+        if parts is not None:
+            parts.append(pre)
+
+        self._link_url(match, pre, parts)
+
+    def _find_url(self, match):
+        '''Find a valid URL that a username or hashtag runs into.
+
+        Return the URL match and the offset of the text it was matched in, or
+        None and 0.
+        '''
+
+        # Every URL starts with `https?://` or `www.`, and only the text
+        # before the `://` or `.` fits into a username or hashtag. URLs are
+        # only tried where they can start, so long captions aren't searched
+        # once per username or hashtag
+        entity = match.group(0).lower()
+        if 'http' not in entity and 'www' not in entity:
+            return None, 0
+
+        starts = []
+        for prefix in ('http', 'www'):
+            start = entity.find(prefix)
+            while start != -1:
+                starts.append(start)
+                start = entity.find(prefix, start + 1)
+
+        text = match.string
+        for start in sorted(starts):
+            start += match.start(0)
+            if not text[start:start + 8].lower().startswith(URL_STARTS):
+                continue
+
+            # URLs contain no whitespace, so match only up to the next one,
+            # with the character before the URL and the one before that
+            offset = start - 2 if start > 1 else 0
+            end = NON_SPACES_REGEX.match(text, start).end(0)
+            url = URL_REGEX.match(text[offset:end], start - 1 - offset)
+            if url is not None and self._is_valid_url(url):
+                return url, offset
+
+        return None, 0
+
+    def _is_valid_url(self, match):
+        '''Check a URL match for the domains the regex can't rule out.'''
 
         # Fix a bug in the regex concerning www...com and www.-foo.com domains
         # TODO fix this in the regex instead of working around it here
-        domain = match.group(5)
-        if domain[0] in '.-':
-            return mat
+        domain = match.group('domain')
+        if domain.startswith(('.', '-')):
+            return False
 
         # Only allow IANA one letter domains that are actually registered
-        if len(domain) == 5 \
-           and domain[-4:].lower() in ('.com', '.org', '.net') \
-           and not domain.lower() in IANA_ONE_LETTER_DOMAINS:
+        if len(domain) == 5:
+            domain = domain.lower()
+            if domain[-4:] in IANA_ONE_LETTER_TLDS \
+               and domain not in IANA_ONE_LETTER_DOMAINS:
 
-            return mat
+                return False
 
-        # Check for urls without http(s)
-        pos = mat.find('http')
-        if pos != -1:
-            pre, url = mat[:pos], mat[pos:]
-            full_url = url
+        return True
 
-        # Find the www and force https://
-        else:
-            pos = mat.lower().find('www')
-            pre, url = mat[:pos], mat[pos:]
-            full_url = 'https://%s' % url
+    def _link_url(self, match, pre, parts, offset=0):
+        '''Collect a valid URL and the usernames and hashtags in it.
 
-        if self._include_spans:
-            span = match.span(0)
-            # add an offset if pre is e.g. ' '
-            span = (span[0] + len(pre), span[1])
-            self._urls.append((url, span))
-        else:
-            self._urls.append(url)
+        `offset` is the position in the caption/comment of the text the URL
+        was matched in.
+        '''
 
-        if self._html:
-            return '%s%s' % (pre, self.format_url(
-                full_url, self._shorten_url(escape(url))))
+        text, start, end = match.string, match.start(0) + len(pre), match.end(0)
+        url = text[start:end]
+        self._urls.append(url)
+        if self._include_spans:
+            self._url_spans.append((offset + start, offset + end))
+
+        # Users and hashtags in valid URLs are collected, but not linked. Like
+        # in _parse_region() only the URL and the character before it are
+        # matched
+        context = start - 1 if start else 0
+        offset += context
+        for entity in USER_TAG_REGEX.finditer(text[context:end],
+                                              start - context):
+            if entity.lastgroup == 'user':
+                self._collect_user(entity, offset)
+            else:
+                self._collect_tag(entity, offset)
+
+        if parts is not None:
+            # Force https:// on URLs without http(s)
+            full_url = url if match.group('scheme') else 'https://' + url
+            parts.append(self.format_url(full_url,
+                                         self._shorten_url(escape(url))))
 
     def _parse_username(self, string):
         '''Parse individual username'''
-        extra = ''
 
-        # If user name starts with a dot, it's invalid
-        if string[0] == '.':
+        # Most usernames have no dots, those are always valid
+        if '.' not in string:
+            return string, ''
+
+        # If user name starts with a dot, it's invalid. Dots at the end and
+        # repeated dots are cut off, `foo..bar.` becoming `foo` and `..bar.`
+        match = VALID_USERNAME_REGEX.match(string)
+        if match is None:
             return None, None
 
-        # Strip dots from the end
-        stripped = string.rstrip('.')
-        if len(stripped) is not len(string):
-            extra += string[len(stripped):]
-            string = stripped
+        return match.group(1), match.group(2)
 
-        # Cut off username if it has repeated dots, `foo..bar` becoming `foo`
-        index = string.find('..')
-        if index > 0:
-            extra += string[index:]
-            string = string[:index]
+    def _parse_users(self, match, parts, offset=0):
+        '''Parse usernames.'''
 
-        return string, extra
+        parsed_username, extra = self._collect_user(match, offset)
+        if parts is None:
+            return
 
-    def _parse_users(self, match):
-        '''Parse usernames.'''
+        if not parsed_username:
+            parts.append(match.group(0))
+        else:
+            parts.append(self.format_username(match.group(0)[0:1],
+                                              parsed_username) + extra)
+
+    def _collect_user(self, match, offset=0):
+        '''Collect a username, return it and any text cut off from it.'''
 
         # Don't parse lists here
-        if match.group(2) is not None:
-            return match.group(0)
+        if match.group('list') is not None:
+            return None, None
 
-        mat = match.group(0)
+        parsed_username, extra = self._parse_username(
+            match.group('username'))
+        if parsed_username:
+            self._users.append(parsed_username)
 
-        parsed_username, extra = self._parse_username(mat[1:])
+        return parsed_username, extra
 
-        if not parsed_username:
-            if self._html:
-                return mat
-            return
+    def _collect_user_with_span(self, match, offset=0):
+        '''Collect a username and its span, see `_collect_user()`.'''
 
-        if self._include_spans:
-            self._users.append((parsed_username, match.span(0)))
-        else:
+        if match.group('list') is not None:
+            return None, None
+
+        parsed_username, extra = self._parse_username(
+            match.group('username'))
+        if parsed_username:
+            start, end = match.span(0)
             self._users.append(parsed_username)
+            self._user_spans.append((offset + start, offset + end))
 
-        if self._html:
-            return self.format_username(mat[0:1], parsed_username) + extra
+        return parsed_username, extra
 
-    def _parse_tags(self, match):
+    def _parse_tags(self, match, parts, offset=0):
         '''Parse hashtags.'''
 
-        mat = match.group(0)
+        tag, text = self._collect_tag(match, offset)
+        if parts is not None:
+            parts.append(self.format_tag(tag, text))
 
-        # Fix problems with the regex capturing stuff infront of the #
-        tag = None
-        for i in '#\uff03':
-            pos = mat.rfind(i)
-            if pos != -1:
-                tag = i
-                break
+    def _collect_tag(self, match, offset=0):
+        '''Collect a hashtag, return its hash sign and text.'''
 
-        pre, text = mat[:pos], mat[pos + 1:]
-        if self._include_spans:
-            span = match.span(0)
-            # add an offset if pre is e.g. ' '
-            span = (span[0] + len(pre), span[1])
-            self._tags.append((text, span))
-        else:
-            self._tags.append(text)
+        tag, text = match.group('hash', 'tag')
+        self._tags.append(text)
+        return tag, text
+
+    def _collect_tag_with_span(self, match, offset=0):
+        '''Collect a hashtag and its span, see `_collect_tag()`.'''
 
-        if self._html:
-            return '%s%s' % (pre, self.format_tag(tag, text))
+        tag, text = match.group('hash', 'tag')
+        start, end = match.span(0)
+        self._tags.append(text)
+        self._tag_spans.append((offset + start, offset + end))
+        return tag, text
 
     def _shorten_url(self, text):
         '''Shorten a URL and make sure to not cut of html entities.'''
 
         if len(text) > self._max_url_length and self._max_url_length != -1:
-            text = text[0:self._max_url_length - 3]
-            amp = text.rfind('&')
-            close = text.rfind(';')
-            if amp != -1 and (close == -1 or close < amp):
-                text = text[0:amp]
-
-            return text + '...'
+            return shorten_url(text, self._max_url_length)
 
         else:
             return text
@@ -276,8 +612,15 @@ class Parser(object):
     # User defined formatters -------------------------------------------------
     def format_tag(self, tag, text):
         '''Return formatted HTML for a hashtag.'''
+
+        # Most hashtags are plain ASCII, which quote() would leave as is
+        if SAFE_TAG_CHARS.issuperset(text):
+            quoted = text
+        else:
+            quoted = quote(text.encode('utf-8'))
+
         return '<a href="https://instagram.com/explore/tags/%s/">%s%s</a>' \
-            % (quote((text).encode('utf-8')), tag, text)
+            % (quoted, tag, text)
 
     def format_username(self, at_char, user):
         '''Return formatted HTML for a username.'''
@@ -289,9 +632,39 @@ class Parser(object):
         return '<a href="%s">%s</a>' % (escape(url), text)
 
 
+# Parsers keep state while parsing, so every thread gets its own
+_local = threading.local()
+
+
+def parse(text, html=True):
+    '''Parse the text with a default Parser and return a ParseResult.'''
+    try:
+        parser = _local.parser
+    except AttributeError:
+        parser = _local.parser = Parser()
+
+    return parser.parse(text, html)
+
+
+# The same URLs tend to show up in many captions
+@lru_cache(maxsize=4096)
+def shorten_url(text, max_length):
+    '''Cut a URL down to max_length, without cutting html entities in half.'''
+    text = text[0:max_length - 3]
+    amp = text.rfind('&')
+    close = text.rfind(';')
+    if amp != -1 and (close == -1 or close < amp):
+        text = text[0:amp]
+
+    return text + '...'
+
+
 # Simple URL escaper
+ESCAPE_TABLE = {ord('&'): '&amp;', ord('"'): '&quot;',
+                ord('\''): '&apos;', ord('>'): '&gt;',
+                ord('<'): '&lt;'}
+
+
 def escape(text):
     '''Escape some HTML entities.'''
-    return ''.join({'&': '&amp;', '"': '&quot;',
-                    '\'': '&apos;', '>': '&gt;',
-                    '<': '&lt;'}.get(c, c) for c in text)
+    return text.translate(ESCAPE_TABLE)
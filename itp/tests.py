@@ -19,6 +19,7 @@
 # twp - Unittests -------------------------------------------------------------
 # -----------------------------------------------------------------------------
 from __future__ import unicode_literals
+import re
 import unittest
 import itp
 
@@ -53,6 +54,62 @@ class TWPTests(unittest.TestCase):
         )
         self.assertEqual(result.urls, ['http://www.flickr.com/photos/29674651@N00/4382024406'])
 
+    def test_all_without_html(self):
+        result = self.parser.parse('@user.name #tag www.example.com/@other#path', html=False)
+        self.assertEqual(result.html, None)
+        self.assertEqual(result.urls, ['www.example.com/@other#path'])
+        self.assertEqual(result.users, ['user.name', 'other'])
+        self.assertEqual(result.tags, ['tag', 'path'])
+
+    def test_all_running_into_urls(self):
+        result = self.parser.parse('#summerhttp://example.com')
+        self.assertEqual(result.html, '<a href="https://instagram.com/explore/tags/summer/">#summer</a>'
+                                      '<a href="http://example.com">http://example.com</a>')
+        self.assertEqual(result.urls, ['http://example.com'])
+        self.assertEqual(result.tags, ['summer'])
+
+        result = self.parser.parse('@nike.www.nike.com')
+        self.assertEqual(result.html, '<a href="https://instagram.com/nike">@nike</a>.'
+                                      '<a href="https://www.nike.com">www.nike.com</a>')
+        self.assertEqual(result.urls, ['www.nike.com'])
+        self.assertEqual(result.users, ['nike'])
+
+    def test_all_same_with_and_without_html(self):
+        for text in ('#summerhttp://example.com', '@nike.www.nike.com', 'hi @bob.http://x.com',
+                     '#www.google.com', '#sumhttp://a.b'):
+            result = self.parser.parse(text)
+            text_result = self.parser.parse(text, html=False)
+            self.assertEqual((result.urls, result.users, result.tags),
+                             (text_result.urls, text_result.users, text_result.tags))
+
+    def test_all_many_entities_not_running_into_urls(self):
+        result = self.parser.parse(' '.join(['#wwwdc @httpbin'] * 2000))
+        self.assertEqual(result.tags, ['wwwdc'] * 2000)
+        self.assertEqual(result.users, ['httpbin'] * 2000)
+        self.assertEqual(result.urls, [])
+
+    def test_all_nothing_to_parse(self):
+        result = self.parser.parse('just some text.')
+        self.assertEqual(result.html, 'just some text.')
+        self.assertEqual((result.urls, result.users, result.reply, result.tags), ([], [], None, []))
+
+        result = self.parser.parse('just some text.', html=False)
+        self.assertEqual(result.html, None)
+
+    def test_parse_batch(self):
+        results = self.parser.parse_batch(['@username', 'nothing', '#hashtag'], html=False)
+        self.assertEqual([(r.users, r.reply, r.tags) for r in results], [
+            (['username'], 'username', []), ([], None, []), ([], None, ['hashtag'])
+        ])
+
+    def test_parse_default_parser(self):
+        first = itp.parse('#first')
+        second = itp.parse('#second', html=False)
+        self.assertEqual(first.tags, ['first'])
+        self.assertEqual(first.html, '<a href="https://instagram.com/explore/tags/first/">#first</a>')
+        self.assertEqual(second.tags, ['second'])
+        self.assertEqual(second.html, None)
+
     # URL tests ----------------------------------------------------------------
     # --------------------------------------------------------------------------
     def test_url_mid(self):
@@ -185,6 +242,15 @@ class TWPTests(unittest.TestCase):
         )
         self.assertEqual(result.urls, ['http://word-and-a-number-8-ftw.domain.tld/'])
 
+    def test_url_hashtags_not_linked(self):
+        result = self.parser.parse('text http://example.com/#tag1#tag2 #tag3')
+        self.assertEqual(result.html, (
+            'text <a href="http://example.com/#tag1#tag2">http://example.com/#tag1#tag2</a> '
+            '<a href="https://instagram.com/explore/tags/tag3/">#tag3</a>'
+        ))
+        self.assertEqual(result.urls, ['http://example.com/#tag1#tag2'])
+        self.assertEqual(result.tags, ['tag1', 'tag2', 'tag3'])
+
     # URL not tests ------------------------------------------------------------
     def test_not_url_dotdotdot(self):
         result = self.parser.parse('Is www...foo a valid URL?')
@@ -196,6 +262,10 @@ class TWPTests(unittest.TestCase):
         self.assertEqual(result.html, 'Is www.-foo.com a valid URL?')
         self.assertEqual(result.urls, [])
 
+    def test_not_url_many_hypens(self):
+        result = self.parser.parse('Is http://%s a valid URL?' % ('-' * 50))
+        self.assertEqual(result.urls, [])
+
     def test_not_url_no_tld(self):
         result = self.parser.parse('Is http://no-tld a valid URL?')
         self.assertEqual(result.html, 'Is http://no-tld a valid URL?')
@@ -206,6 +276,13 @@ class TWPTests(unittest.TestCase):
         self.assertEqual(result.html, 'Is http://tld-too-short.x a valid URL?')
         self.assertEqual(result.urls, [])
 
+    def test_not_url_hashtag_linked(self):
+        result = self.parser.parse('text http://a.com/#hashtag')
+        self.assertEqual(
+            result.html, 'text http://a.com/<a href="https://instagram.com/explore/tags/hashtag/">#hashtag</a>')
+        self.assertEqual(result.urls, [])
+        self.assertEqual(result.tags, ['hashtag'])
+
     def test_all_not_break_url_at2(self):
         result = self.parser.parse('http://www.flickr.com/photos/29674651@N00/4382024406')
         self.assertEqual(
@@ -343,6 +420,21 @@ class TWPTests(unittest.TestCase):
         self.assertEqual(result.html, '<a href="https://WWW.EXAMPLE.COM">WWW.EXAMPLE.COM</a>')
         self.assertEqual(result.urls, ['WWW.EXAMPLE.COM'])
 
+    def test_url_mixed_case_www(self):
+        result = self.parser.parse('Www.Example.com')
+        self.assertEqual(result.html, '<a href="https://Www.Example.com">Www.Example.com</a>')
+        self.assertEqual(result.urls, ['Www.Example.com'])
+
+    def test_url_HTTP(self):
+        result = self.parser.parse('HTTP://EXAMPLE.COM')
+        self.assertEqual(result.html, '<a href="HTTP://EXAMPLE.COM">HTTP://EXAMPLE.COM</a>')
+        self.assertEqual(result.urls, ['HTTP://EXAMPLE.COM'])
+
+    def test_url_www_http_domain(self):
+        result = self.parser.parse('see www.http.com')
+        self.assertEqual(result.html, 'see <a href="https://www.http.com">www.http.com</a>')
+        self.assertEqual(result.urls, ['www.http.com'])
+
     def test_url_www(self):
         result = self.parser.parse('www.example.com')
         self.assertEqual(result.html, '<a href="https://www.example.com">www.example.com</a>')
@@ -401,6 +493,12 @@ class TWPTests(unittest.TestCase):
         self.assertEqual(result.html, 'badly formatted http://foo_bar.com')
         self.assertEqual(result.urls, [])
 
+    # Escape tests -------------------------------------------------------------
+    # --------------------------------------------------------------------------
+    def test_escape(self):
+        self.assertEqual(itp.escape('a&b"c\'d<e>f'), 'a&amp;b&quot;c&apos;d&lt;e&gt;f')
+        self.assertEqual(itp.escape('nothing to escape'), 'nothing to escape')
+
     # Hashtag tests ------------------------------------------------------------
     # --------------------------------------------------------------------------
     def test_hashtag_followed_full_whitespace(self):
@@ -568,6 +666,17 @@ class TWPTests(unittest.TestCase):
         self.assertEqual(result.html, 'text <a href="https://instagram.com/user">@user</a>..name')
         self.assertEqual(result.users, ['user'])
 
+    def test_username_with_repeated_and_ending_dots(self):
+        result = self.parser.parse('text @user..name.')
+        self.assertEqual(result.html, 'text <a href="https://instagram.com/user">@user</a>..name.')
+        self.assertEqual(result.users, ['user'])
+
+    def test_username_non_ascii_letters(self):
+        result = self.parser.parse('hi @\u212aate and @loves\u017fun')
+        self.assertEqual(result.html, 'hi @\u212aate and <a href="https://instagram.com/loves">@loves</a>\u017fun')
+        self.assertEqual(result.users, ['loves'])
+        self.assertEqual(self.parser.parse('hi @\u212aate and @loves\u017fun', html=False).users, ['loves'])
+
     def test_usernames_with_only_one_character(self):
         result = self.parser.parse('text @a')
         self.assertEqual(result.html, 'text <a href="https://instagram.com/a">@a</a>')
@@ -632,6 +741,24 @@ class TWPTestsWithSpans(unittest.TestCase):
             ('CokeZero', (7, 16)), ('EASPORTS', (47, 56)), ('EANCAAFootball', (57, 72)), ('someone', (116, 124))
         ])
 
+    def test_spans_separately(self):
+        result = self.parser.parse('@user #hash http://some.com', html=False)
+        self.assertEqual(result.url_strings, ['http://some.com'])
+        self.assertEqual(result.url_spans, [(12, 27)])
+        self.assertEqual(result.user_strings, ['user'])
+        self.assertEqual(result.user_spans, [(0, 5)])
+        self.assertEqual(result.tag_strings, ['hash'])
+        self.assertEqual(result.tag_spans, [(6, 11)])
+
+        result = self.parser.parse('nothing', html=False)
+        self.assertEqual((result.urls, result.url_spans), ([], []))
+
+    def test_spans_running_into_url(self):
+        result = self.parser.parse('hi #summerhttp://example.com/@user', html=False)
+        self.assertEqual(result.urls, [('http://example.com/@user', (10, 34))])
+        self.assertEqual(result.users, [('user', (29, 34))])
+        self.assertEqual(result.tags, [('summer', (3, 10))])
+
     def test_edge_cases(self):
         """Some edge cases that upset the original version of itp"""
         result = self.parser.parse(' @user', html=False)
@@ -644,6 +771,40 @@ class TWPTestsWithSpans(unittest.TestCase):
         self.assertEqual(result.urls, [('http://some.com', (1, 16))])
 
 
+class TWPTestsWithRE2(unittest.TestCase):
+
+    """Test that patterns compiled with RE2 match like the re ones"""
+    def setUp(self):
+        try:
+            import re2
+        except ImportError:
+            self.skipTest('RE2 is not installed')
+
+        self.re2, itp.re2 = itp.re2, re2
+
+    def tearDown(self):
+        itp.re2 = self.re2
+
+    def test_unicode_spaces(self):
+        regex = itp._compile(itp.URL_EXP, re.IGNORECASE)
+        self.assertNotIsInstance(regex, type(re.compile('')))
+
+        text = 'check http://example.com\xa0and\xa0buy.org'
+        self.assertEqual(regex.search(text).group(0), ' http://example.com')
+        self.assertEqual(itp._compile(r'a\sb').match('a\u3000b').group(0), 'a\u3000b')
+
+    def test_dotted_and_dotless_i(self):
+        regex = itp._compile(itp.HASHTAG_EXP, re.IGNORECASE)
+        self.assertNotIsInstance(regex, type(re.compile('')))
+
+        text = '#\u0131rmak #\u0130stanbul #stra\u00dfe'
+        self.assertEqual([m.group('tag') for m in regex.finditer(text)],
+                         ['\u0131rmak', '\u0130stanbul', 'stra\u00dfe'])
+
+        regex = itp._compile(itp.USER_EXP % r'\B', re.IGNORECASE)
+        self.assertEqual([m.group('username') for m in regex.finditer('@ab\u0131 @\u0130x')], ['ab'])
+
+
 # Test it!
 if __name__ == '__main__':
     unittest.main()
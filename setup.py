@@ -1,4 +1,39 @@
 from setuptools import setup
+from setuptools.command.build_ext import build_ext
+
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    cythonize = None
+
+
+class optional_build_ext(build_ext):
+
+    '''Fall back to the pure Python parser if it can't be compiled.'''
+
+    def run(self):
+        try:
+            build_ext.run(self)
+        except Exception as e:
+            self.warn('Could not compile the parser, using pure Python: %s' % e)
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except Exception as e:
+            self.warn('Could not compile %s, using pure Python: %s'
+                      % (ext.name, e))
+
+
+# Compile the parser module with Cython if it's available, this removes most
+# of the interpreter overhead of the per match callbacks
+if cythonize is not None:
+    ext_modules = cythonize(['itp/itp.py'], quiet=True, compiler_directives={
+        'language_level': '3str',
+        'binding': True,
+    })
+else:
+    ext_modules = []
 
 setup(
     name='instagram-text-python',
@@ -10,9 +45,14 @@ setup(
     url='https://github.com/takumihq/instagram-text-python',
     license='MIT',
     packages=['itp'],
+    ext_modules=ext_modules,
+    cmdclass={'build_ext': optional_build_ext},
     include_package_data=True,
     zip_safe=False,
     install_requires=[],
+    extras_require={
+        're2': ['google-re2'],
+    },
     classifiers=[
         'Environment :: Console',
         'Intended Audience :: Developers',